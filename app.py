@@ -10,6 +10,12 @@ from functools import wraps
 import json
 from gtts import gTTS
 import io
+import os
+import glob
+import shutil
+import tempfile
+import pandas as pd
+import pyarrow.parquet as pq
 
 # ---------------- Config ----------------
 app = Flask(__name__)
@@ -20,6 +26,14 @@ DB_NAME = "hushtone_users.db"
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"
 
+# Gesture history retention (rows older than the TTL are moved to the archive)
+HISTORY_ARCHIVE_DIR = os.environ.get("HISTORY_ARCHIVE_DIR", "history_archive")
+GUEST_HISTORY_TTL = int(os.environ.get("GUEST_HISTORY_TTL", 24 * 3600))        # seconds
+USER_HISTORY_TTL = int(os.environ.get("USER_HISTORY_TTL", 30 * 24 * 3600))     # seconds
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 500))        # rows per delete transaction
+RETENTION_PART_SIZE = int(os.environ.get("RETENTION_PART_SIZE", 100000))      # rows archived per pass step
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", 3600))           # seconds between sweeps
+
 # ---------------- Load Languages ----------------
 with open("languages.json", encoding="utf-8") as f:
     translations = json.load(f)
@@ -54,6 +68,10 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
         """)
+        # Indexes for the per-user/per-guest lookups and the retention sweep
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON gesture_history (timestamp)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_history_user ON gesture_history (user_id, timestamp)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_history_guest ON gesture_history (guest_id, timestamp)")
         cur.execute("""
         CREATE TABLE IF NOT EXISTS gesture_meanings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -234,6 +252,197 @@ def gesture_thread():
                             gesture_image = gesture_images[gesture]
         frame = img
 
+# ---------------- History Retention ----------------
+retention_lock = threading.Lock()       # held by sweeps and archive clears
+retention_start_lock = threading.Lock()
+retention_started = False
+
+HISTORY_DTYPES = {
+    "id": "int64",
+    "user_id": "Int64",
+    "guest_id": "object",
+    "gesture": "object",
+    "action_text": "object",
+    "timestamp": "object",
+}
+ARCHIVE_ROW_GROUP_SIZE = 10000
+
+def archive_partition_dir(day):
+    """Directory holding the archived rows for one day (YYYY-MM-DD)"""
+    return os.path.join(HISTORY_ARCHIVE_DIR, f"date={day}")
+
+def write_archive_part(part_dir, df):
+    """Write rows as one Parquet part in part_dir, sorted by id, and return its path"""
+    df = df.astype(HISTORY_DTYPES).sort_values("id")
+    os.makedirs(part_dir, exist_ok=True)
+    # Names stay unique so a part is never overwritten, even by a compaction of itself
+    path = os.path.join(part_dir, f"part-{df['id'].min()}-{df['id'].max()}-{uuid4().hex[:8]}.parquet")
+    # Write to a uniquely named temp file next to the final one and rename, so
+    # neither a crash nor a concurrent sweep in another worker leaves a partial part
+    fd, tmp_path = tempfile.mkstemp(dir=part_dir, suffix=".tmp")
+    os.close(fd)
+    df.to_parquet(tmp_path, engine="pyarrow", compression="snappy", index=False,
+                  row_group_size=ARCHIVE_ROW_GROUP_SIZE)
+    os.replace(tmp_path, path)
+    return path
+
+def write_archive_batch(df):
+    """Write expired rows into their daily partitions and return the partitions touched"""
+    part_dirs = set()
+    for day, part in df.groupby(df["timestamp"].str[:10]):
+        part_dir = archive_partition_dir(day)
+        write_archive_part(part_dir, part)
+        part_dirs.add(part_dir)
+    return part_dirs
+
+def compact_archive_partition(part_dir):
+    """Merge all readable parts of a partition into a single part"""
+    paths = glob.glob(os.path.join(part_dir, "*.parquet"))
+    if len(paths) < 2:
+        return
+    frames = []
+    merged = []
+    for path in paths:
+        try:
+            frames.append(pd.read_parquet(path, engine="pyarrow"))
+        except Exception as e:
+            print(f"Not compacting unreadable history archive {path}: {e}")
+            continue
+        merged.append(path)
+    if len(merged) < 2:
+        return
+    write_archive_part(part_dir, pd.concat(frames, ignore_index=True).drop_duplicates(subset="id"))
+    for path in merged:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # already compacted away by a sweep in another worker
+
+def archive_expired_rows(owner_clause, ttl, batch_size, part_dirs):
+    """Archive and delete the rows matching owner_clause that are older than ttl seconds.
+
+    Rows are taken oldest first, so the query walks an index on timestamp and
+    only ever touches expired rows. Up to RETENTION_PART_SIZE rows are written
+    to the archive at a time, then deleted in batch_size chunks. Partitions
+    written to are added to part_dirs.
+    """
+    with get_db_conn() as conn:
+        cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{ttl} seconds",)).fetchone()[0]
+    archived = 0
+    while True:
+        with get_db_conn() as conn:
+            df = pd.read_sql_query(f"""
+                SELECT id, user_id, guest_id, gesture, action_text, timestamp
+                FROM gesture_history
+                WHERE {owner_clause} AND timestamp < ?
+                ORDER BY timestamp, id LIMIT ?
+            """, conn, params=(cutoff, RETENTION_PART_SIZE))
+        if df.empty:
+            break
+        part_dirs |= write_archive_batch(df)
+        # Each chunk is exactly the rows up to its last (timestamp, id) key, so
+        # delete by that range instead of binding one parameter per row
+        for end in range(batch_size, len(df) + batch_size, batch_size):
+            last = df.iloc[min(end, len(df)) - 1]
+            with get_db_conn() as conn:
+                cur = conn.cursor()
+                cur.execute(f"""
+                    DELETE FROM gesture_history
+                    WHERE {owner_clause} AND timestamp <= ?
+                      AND (timestamp < ? OR id <= ?)
+                """, (last["timestamp"], last["timestamp"], int(last["id"])))
+                conn.commit()
+            time.sleep(0.05)  # let pending writers grab the lock between batches
+        archived += len(df)
+        if len(df) < RETENTION_PART_SIZE:
+            break
+    return archived
+
+def archive_expired_history(batch_size=None):
+    """Move gesture_history rows past their TTL into the archive.
+
+    Guest and user rows are swept separately so each pass can use an index
+    (idx_history_user for guests, idx_history_timestamp for users). Rows are
+    written to the archive before they are deleted, and every delete is its own
+    short transaction so the recognition thread is never blocked for long.
+    Afterwards each partition written to is compacted back to a single part.
+    Sweeps hold retention_lock, so they never overlap each other or an
+    archive clear.
+    """
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    part_dirs = set()
+    with retention_lock:
+        archived = archive_expired_rows("user_id IS NULL", GUEST_HISTORY_TTL, batch_size, part_dirs)
+        archived += archive_expired_rows("user_id IS NOT NULL", USER_HISTORY_TTL, batch_size, part_dirs)
+        for part_dir in part_dirs:
+            compact_archive_partition(part_dir)
+        return archived
+
+def archive_part_max_id(path):
+    """Highest id in a part, taken from its part-{min}-{max}-{suffix}.parquet name"""
+    return int(os.path.basename(path).split("-")[2])
+
+def load_archived_history(limit=50):
+    """Return the newest `limit` archived rows (highest ids first) as a DataFrame.
+
+    Parts are opened newest id first and read one row group at a time from
+    the end, stopping once `limit` rows newer than anything still unread have
+    been collected, so a page load reads about one row group.
+    """
+    paths = sorted(glob.glob(os.path.join(archive_partition_dir("*"), "*.parquet")),
+                   key=archive_part_max_id, reverse=True)
+    frames = []
+    seen = set()
+
+    def have_newer_than(max_id):
+        return sum(1 for i in seen if i > max_id) >= limit
+
+    for path in paths:
+        if have_newer_than(archive_part_max_id(path)):
+            break
+        try:
+            pf = pq.ParquetFile(path)
+            id_col = pf.schema_arrow.get_field_index("id")
+            for rg in reversed(range(pf.num_row_groups)):
+                stats = pf.metadata.row_group(rg).column(id_col).statistics
+                if stats is not None and stats.has_min_max and have_newer_than(stats.max):
+                    break
+                df = pf.read_row_group(rg).to_pandas().astype(HISTORY_DTYPES)
+                frames.append(df)
+                seen.update(int(i) for i in df["id"])
+        except Exception as e:
+            print(f"Skipping unreadable history archive {path}: {e}")
+    if not frames:
+        return pd.DataFrame(columns=list(HISTORY_DTYPES)).astype(HISTORY_DTYPES)
+    # A sweep interrupted between write and delete can archive a row twice
+    df = pd.concat(frames, ignore_index=True).drop_duplicates(subset="id")
+    return df.sort_values("id", ascending=False).head(limit)
+
+def clear_history_archive():
+    with retention_lock:
+        if os.path.isdir(HISTORY_ARCHIVE_DIR):
+            shutil.rmtree(HISTORY_ARCHIVE_DIR)
+
+def retention_thread():
+    while True:
+        try:
+            archive_expired_history()
+        except Exception as e:
+            print(f"History retention sweep failed: {e}")
+        time.sleep(RETENTION_INTERVAL)
+
+# Started from the first request rather than at import, so only the serving
+# process sweeps (not the debug reloader's watcher process)
+@app.before_request
+def start_retention_thread():
+    global retention_started
+    if retention_started:
+        return
+    with retention_start_lock:
+        if not retention_started:
+            threading.Thread(target=retention_thread, daemon=True).start()
+            retention_started = True
+
 # ---------------- Video Generator ----------------
 def gen_frames():
     global frame
@@ -463,7 +672,22 @@ def view_history():
             ORDER BY gh.timestamp DESC LIMIT 50
         """)
         history = cur.fetchall()
-    return render_template("admin_history.html", history=history)
+        include_archive = request.args.get('archive') == '1'
+        if include_archive:
+            cur.execute("SELECT id, username FROM users")
+            usernames = dict(cur.fetchall())
+    if include_archive:
+        archived = load_archived_history(limit=50)
+        # A sweep interrupted between write and delete leaves a row in both places
+        archived = archived[~archived["id"].isin([h[0] for h in history])]
+        history += [
+            (int(r.id), usernames.get(int(r.user_id)) if pd.notna(r.user_id) else None,
+             r.gesture, r.action_text, r.timestamp)
+            for r in archived.itertuples(index=False)
+        ]
+        history.sort(key=lambda h: h[4] or '', reverse=True)
+        history = history[:50]
+    return render_template("admin_history.html", history=history, include_archive=include_archive)
 
 
 # 3️⃣ Gesture Meaning Approvals page
@@ -535,9 +759,22 @@ def clear_history():
         cur = conn.cursor()
         cur.execute("DELETE FROM gesture_history")
         conn.commit()
+    clear_history_archive()
     flash("All gesture history cleared.")
     return redirect(url_for('view_history'))
 
+# Archive expired gesture history now instead of waiting for the next sweep
+@app.route('/admin/run_retention')
+@admin_required
+def run_retention():
+    # A first sweep over a large table can take minutes, so never run it in the request
+    if retention_lock.locked():
+        flash("A history retention sweep is already running.")
+    else:
+        threading.Thread(target=archive_expired_history, daemon=True).start()
+        flash("History retention sweep started.")
+    return redirect(url_for('view_history'))
+
 # View all gesture submissions (approved, rejected, pending)
 @app.route('/admin/all_submissions')
 @admin_required
@@ -665,7 +902,6 @@ def speak():
 
 # ---------------- Run ----------------
 if __name__ == "__main__":
-    import os
     port = int(os.environ.get("PORT", 5000))  # Use Render's PORT or 5000 locally
     app.run(host="0.0.0.0", port=port, debug=True, threaded=True)
 